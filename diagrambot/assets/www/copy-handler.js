@@ -0,0 +1,28 @@
+// Copy-to-clipboard message handler shared by the chat and voice apps.
+// Served as a static file so browsers cache it across page loads instead
+// of re-downloading it inline with every page.
+Shiny.addCustomMessageHandler("copy_to_clipboard", function(msg) {
+    console.log('Copy to clipboard handler called with:', msg);
+    const text = msg.text;
+    navigator.clipboard.writeText(text).then(function() {
+        console.log("Copied successfully:", text.substring(0, 50) + "...");
+    }).catch(function(err) {
+        console.warn("Copy failed:", err);
+        // Fallback method
+        try {
+            const textArea = document.createElement('textarea');
+            textArea.value = text;
+            textArea.style.position = 'fixed';
+            textArea.style.left = '-999999px';
+            textArea.style.top = '-999999px';
+            document.body.appendChild(textArea);
+            textArea.focus();
+            textArea.select();
+            document.execCommand('copy');
+            document.body.removeChild(textArea);
+            console.log("Copied using fallback method");
+        } catch (fallbackErr) {
+            console.error("Fallback copy also failed:", fallbackErr);
+        }
+    });
+});
@@ -2,51 +2,223 @@
 Chat-based diagrambot functionality.
 """
 
+import functools
+import hashlib
+import html
+import logging
 import json
+import string
 import zlib
-import base64
 import os
+from collections import OrderedDict
+from dataclasses import dataclass, replace
 from pathlib import Path
 from typing import Any, Dict
 
+try:
+    # orjson serializes straight to bytes, skipping the separate UTF-8
+    # encode before base64; fall back to stdlib json when unavailable
+    import orjson
+except ImportError:
+    orjson = None
+
 from chatlas import ChatOpenAI
 from shiny import App, Inputs, Outputs, Session, reactive, render, ui
-from dotenv import load_dotenv
 
 from .utils import ensure_openai_api_key, build_prompt
 
-load_dotenv()
-
 # Import helper functions from voice.py
 from .voice import (
+    _b64url,
     hidden_audio_el,
-    base64_to_base64url,
     create_kroki_encoding,
     generate_external_links_content,
     render_diagram_output,
 )
 
+logger = logging.getLogger("diagrambot.chat")
 
-def create_chat_diagram_tool(last_code, last_diagram_type, debug=False):
-    """Create diagram generation tool for chat interface."""
-    
-    def generate_diagram(code: str, diagram_type: str):
+# Reuse the rendered diagram UI for identical (code, diagram_type) pairs;
+# Shiny tag objects are immutable once built, so resending a cached
+# element is safe and skips the escaping and HTML assembly on re-render.
+_render_diagram_cached = functools.lru_cache(maxsize=32)(render_diagram_output)
+
+# Package-relative asset paths, resolved once at import.
+_PKG_DIR = Path(__file__).parent
+_SHUTTER_MP3 = str(_PKG_DIR / "assets" / "shutter.mp3")
+_RENDERERS_JS_PATH = _PKG_DIR / "assets" / "www" / "diagram-renderers.js"
+
+# Static UI pieces built once at import rather than per app construction.
+_SHUTTER_AUDIO = hidden_audio_el("shutter", _SHUTTER_MP3)
+_RENDERERS_JS = ui.include_js(_RENDERERS_JS_PATH)
+_COPY_TO_CLIPBOARD_JS = ui.include_js(
+    _PKG_DIR / "assets" / "www" / "copy-handler.js"
+)
+
+
+# Link-modal HTML scaffolding, compiled once; only the URLs vary per call.
+_MERMAID_LINKS_TMPL = string.Template("""
+<div class="mb-3">
+    <h6>🖼️ Mermaid Ink (Image)</h6>
+    <p class="small text-muted">Direct link to PNG image</p>
+    <div class="input-group mb-2">
+        <input type="text" class="form-control" value="$ink_url" readonly onclick="this.select()">
+        <button class="btn btn-outline-secondary" onclick="window.open('$ink_url', '_blank')">Open</button>
+    </div>
+</div>
+<div class="mb-3">
+    <h6>✏️ Mermaid Live Editor</h6>
+    <p class="small text-muted">Interactive editor</p>
+    <div class="input-group mb-2">
+        <input type="text" class="form-control" value="$live_url" readonly onclick="this.select()">
+        <button class="btn btn-outline-secondary" onclick="window.open('$live_url', '_blank')">Open</button>
+    </div>
+</div>
+""")
+
+_GRAPHVIZ_LINKS_TMPL = string.Template("""
+<div class="mb-3">
+    <h6>📊 Kroki (SVG)</h6>
+    <p class="small text-muted">Scalable vector graphics</p>
+    <div class="input-group mb-2">
+        <input type="text" class="form-control" value="$svg_url" readonly onclick="this.select()">
+        <button class="btn btn-outline-secondary" onclick="window.open('$svg_url', '_blank')">Open</button>
+    </div>
+</div>
+<div class="mb-3">
+    <h6>🖼️ Kroki (PNG)</h6>
+    <p class="small text-muted">Portable network graphics</p>
+    <div class="input-group mb-2">
+        <input type="text" class="form-control" value="$png_url" readonly onclick="this.select()">
+        <button class="btn btn-outline-secondary" onclick="window.open('$png_url', '_blank')">Open</button>
+    </div>
+</div>
+""")
+
+# Cache of generated links HTML, keyed by a short digest of the diagram code
+# rather than the code itself so large sources are not retained as keys.
+_LINKS_HTML_CACHE = OrderedDict()
+_LINKS_HTML_CACHE_SIZE = 64
+
+
+def _links_html_for(code: str, diagram_type: str) -> str:
+    """Build the external-links HTML for a diagram, memoized per (code, type).
+
+    Repeat clicks on the External Links button for the same diagram skip
+    the base64/zlib/JSON work entirely. Entries are keyed by a 16-byte
+    blake2b fingerprint of the code so cache memory stays bounded even
+    for very large diagram sources.
+    """
+    fingerprint = hashlib.blake2b(code.encode('utf-8'), digest_size=16).hexdigest()
+    key = (fingerprint, diagram_type)
+
+    cached = _LINKS_HTML_CACHE.get(key)
+    if cached is not None:
+        _LINKS_HTML_CACHE.move_to_end(key)
+        return cached
+
+    links_html = _build_links_html(code, diagram_type)
+    _LINKS_HTML_CACHE[key] = links_html
+    if len(_LINKS_HTML_CACHE) > _LINKS_HTML_CACHE_SIZE:
+        _LINKS_HTML_CACHE.popitem(last=False)
+    return links_html
+
+
+def _build_links_html(code: str, diagram_type: str) -> str:
+    """Build the external-links HTML for a diagram (uncached)."""
+    if diagram_type == "mermaid":
+        # Create Mermaid Ink link
+        mermaid_ink_encoded = _b64url(code.encode('utf-8'))
+        mermaid_ink_url = f"https://mermaid.ink/img/{mermaid_ink_encoded}"
+
+        # Create Mermaid Live Editor link
+        mermaid_live_payload = {
+            "code": code,
+            "mermaid": {"theme": "default"}
+        }
+        if orjson is not None:
+            mermaid_json = orjson.dumps(mermaid_live_payload)
+        else:
+            mermaid_json = json.dumps(mermaid_live_payload).encode('utf-8')
+        mermaid_live_encoded = _b64url(mermaid_json)
+        mermaid_live_url = f"https://mermaid.live/edit#base64:{mermaid_live_encoded}"
+
+        return _MERMAID_LINKS_TMPL.substitute(
+            ink_url=html.escape(mermaid_ink_url, quote=True),
+            live_url=html.escape(mermaid_live_url, quote=True),
+        )
+
+    elif diagram_type == "graphviz":
+        # Create Kroki links
+        encoded_code = create_kroki_encoding(code)
+
+        return _GRAPHVIZ_LINKS_TMPL.substitute(
+            svg_url=html.escape(f"https://kroki.io/graphviz/svg/{encoded_code}", quote=True),
+            png_url=html.escape(f"https://kroki.io/graphviz/png/{encoded_code}", quote=True),
+        )
+    else:
+        return "<p>No external links available for this diagram type.</p>"
+
+
+@dataclass(frozen=True)
+class ChatState:
+    """Immutable snapshot of a chat session's diagram state.
+
+    Packing both diagram fields into one reactive value means each tool
+    call notifies dependents at most once; writers publish a new snapshot
+    via dataclasses.replace. Usage totals deliberately live in separate
+    reactive values — folding them in here would invalidate the diagram
+    render and shutter sound on every chat turn.
+    """
+    code: str = ""
+    diagram_type: str = "mermaid"
+
+
+class _DiagramTool:
+    """Diagram generation tool backed by a session's ChatState value.
+
+    A slotted class instead of a closure: attribute loads are cheaper than
+    cell-variable loads on each tool call, and the instance layout is
+    fixed. The bound ``generate_diagram`` method carries the name,
+    docstring and annotations chatlas needs for tool registration.
+    The debug flag is resolved to a trace callable once at construction
+    rather than branching on it in every call.
+    """
+
+    __slots__ = ("state", "_trace")
+
+    def __init__(self, state, debug=False):
+        self.state = state
+        self._trace = print if debug else None
+
+    def generate_diagram(self, code: str, diagram_type: str):
         """Generate a diagram from code and diagram type.
-        
+
         Args:
             code: The diagram code (Mermaid or Graphviz DOT syntax)
             diagram_type: The type of diagram ('mermaid' or 'graphviz')
         """
-        if debug:
-            print(f"Generating {diagram_type} diagram with code:\n{code}")
-        
-        # Set the reactive values
-        last_code.set(code)
-        last_diagram_type.set(diagram_type)
-        
+        if self._trace is not None:
+            self._trace(f"Generating {diagram_type} diagram with code:\n{code}")
+
+        # Publish one new state snapshot covering both fields, so each tool
+        # call notifies dependents at most once; no-op writes are skipped so
+        # regenerating identical code doesn't retrigger the render and
+        # shutter sound
+        state = self.state
+        with reactive.isolate():
+            current = state()
+            if current.code != code or current.diagram_type != diagram_type:
+                state.set(
+                    replace(current, code=code, diagram_type=diagram_type)
+                )
+
         return f"Generated {diagram_type} diagram successfully."
-    
-    return generate_diagram
+
+
+def create_chat_diagram_tool(state, debug=False):
+    """Create diagram generation tool for chat interface."""
+    return _DiagramTool(state, debug=debug).generate_diagram
 
 
 def diagrambot_chat(
@@ -120,38 +292,10 @@ def diagrambot_chat(
             ui.chat_ui(id="chat"),
             fillable=True,
         ),
-        hidden_audio_el("shutter", str(Path(__file__).parent / "assets" / "shutter.mp3")),
+        _SHUTTER_AUDIO,
         ui.tags.head(
-            ui.include_js(Path(__file__).parent / "assets" / "www" / "diagram-renderers.js"),
-            ui.tags.script(
-                """
-                Shiny.addCustomMessageHandler("copy_to_clipboard", function(msg) {
-                    console.log('Copy to clipboard handler called with:', msg);
-                    const text = msg.text;
-                    navigator.clipboard.writeText(text).then(function() {
-                        console.log("Copied successfully:", text.substring(0, 50) + "...");
-                    }).catch(function(err) {
-                        console.warn("Copy failed:", err);
-                        // Fallback method
-                        try {
-                            const textArea = document.createElement('textarea');
-                            textArea.value = text;
-                            textArea.style.position = 'fixed';
-                            textArea.style.left = '-999999px';
-                            textArea.style.top = '-999999px';
-                            document.body.appendChild(textArea);
-                            textArea.focus();
-                            textArea.select();
-                            document.execCommand('copy');
-                            document.body.removeChild(textArea);
-                            console.log("Copied using fallback method");
-                        } catch (fallbackErr) {
-                            console.error("Fallback copy also failed:", fallbackErr);
-                        }
-                    });
-                });
-                """
-            )
+            _RENDERERS_JS,
+            _COPY_TO_CLIPBOARD_JS,
         ),
         title="diagrambot chat",
         style="--bslib-spacer: 1rem;",
@@ -159,23 +303,26 @@ def diagrambot_chat(
     
     # Server
     def server(input: Inputs, output: Outputs, session: Session):
-        last_code = reactive.value()
-        last_diagram_type = reactive.value("mermaid")
-        
+        # Diagram state lives in one reactive value holding an immutable
+        # ChatState snapshot; usage totals are kept apart so per-turn cost
+        # updates don't invalidate the diagram outputs
+        state = reactive.value(ChatState())
+        session_cost = reactive.value(0.0)
+        session_tokens = reactive.value(0)
+
         # Initialize ChatOpenAI client with system prompt
         chat_client = ChatOpenAI(
             model="gpt-4o",
             system_prompt=prompt
         )
-        
-        # Session tracking
-        session_cost = reactive.value(0)
-        session_tokens = reactive.value({"tokens": 0})
-        
+
+        # Running token total; chatlas appends turns monotonically, so only
+        # turns added since the last update need to be summed.
+        seen_turns = 0
+        total_tokens = 0
+
         # Create diagram generation tool function
-        generate_diagram_func = create_chat_diagram_tool(
-            last_code, last_diagram_type, debug=debug
-        )
+        generate_diagram_func = create_chat_diagram_tool(state, debug=debug)
         
         # Register the tool with chat client
         chat_client.register_tool(generate_diagram_func)
@@ -186,25 +333,32 @@ def diagrambot_chat(
         # Define callback for user input
         @chat.on_user_submit
         async def handle_user_input(user_input: str):
+            nonlocal seen_turns, total_tokens
+
             if debug:
                 print(f"User input: {user_input}")
             
             try:
-                # Get response from chat client (using stream for better UX)
-                response = await chat_client.stream_async(user_input)
-                
-                # Add assistant response to chat using the correct method
-                await chat.append_message_stream(response)
+                # Feed the stream straight into the chat component. stream_async
+                # only constructs the async generator; chunks are pulled as
+                # append_message_stream iterates it, so the first tokens render
+                # as soon as they arrive from the model.
+                await chat.append_message_stream(
+                    await chat_client.stream_async(user_input)
+                )
                 
                 # Update cost and token tracking using chatlas methods
                 try:
                     cost = chat_client.get_cost()
+
+                    tokens_list = chat_client.get_tokens() or []
+                    for turn in tokens_list[seen_turns:]:
+                        total_tokens += turn.get('tokens', 0)
+                    seen_turns = len(tokens_list)
+
                     session_cost.set(cost)
-                    
-                    tokens_list = chat_client.get_tokens()
-                    total_tokens = sum(turn.get('tokens', 0) for turn in tokens_list) if tokens_list else 0
-                    session_tokens.set({"tokens": total_tokens})
-                    
+                    session_tokens.set(total_tokens)
+
                     if debug:
                         print(f"Updated cost: ${cost:.4f}, tokens: {total_tokens}")
                 except Exception as tracking_error:
@@ -219,62 +373,36 @@ def diagrambot_chat(
                     "role": "assistant"
                 })
         
-        # Periodic update for cost and token tracking (similar to R version)
-        @reactive.effect
-        def _update_usage_tracking():
-            reactive.invalidate_later(5)  # Update every 5 seconds
-            
-            try:
-                # Get cumulative cost and tokens
-                cost = chat_client.get_cost()
-                session_cost.set(cost)
-                
-                tokens_list = chat_client.get_tokens()
-                total_tokens = sum(turn.get('tokens', 0) for turn in tokens_list) if tokens_list else 0
-                session_tokens.set({"tokens": total_tokens})
-                
-                if debug:
-                    print(f"Periodic update - Cost: ${cost:.4f}, Tokens: {total_tokens}")
-                    
-            except Exception as e:
-                if debug:
-                    print(f"Error in periodic usage tracking: {e}")
-        
         # Handle copy to clipboard button
         @reactive.effect
         @reactive.event(input.copy_code)
         async def _copy_code():
-            print("=== COPY CODE BUTTON CLICKED (PYTHON SIDE) ===")
-            if debug:
-                print("Copy code button clicked")
-                
-            if not last_code():
-                print("No code available to copy")
-                if debug:
-                    print("No code available to copy")
+            logger.debug("Copy code button clicked")
+
+            code_to_copy = state().code
+            if not code_to_copy:
+                logger.debug("No code available to copy")
                 ui.notification_show(
                     "No diagram code available to copy.",
                     type="warning",
                     duration=3
                 )
                 return
-                
-            code_to_copy = last_code()
-            
-            print(f"Code to copy length: {len(code_to_copy)} characters")
-            print(f"Code preview: {code_to_copy[:100]}...")
-            
-            if debug:
-                print(f"Copying code to clipboard: {code_to_copy[:50]}...")
-            
+
+            # Guard so the length/preview arguments aren't built at all
+            # when debug logging is off
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Copying %d characters to clipboard: %.100s...",
+                    len(code_to_copy), code_to_copy
+                )
+
             # Send the code to the browser for copying
-            print("Sending custom message to browser")
             await session.send_custom_message(
                 "copy_to_clipboard",
                 {"text": code_to_copy}
             )
-            print("Custom message sent")
-            
+
             # Show a temporary notification
             ui.notification_show(
                 "Code copied to clipboard!",
@@ -286,82 +414,19 @@ def diagrambot_chat(
         @reactive.effect
         @reactive.event(input.external_links)
         def _show_external_links():
-            if not last_code():
+            current = state()
+            if not current.code:
                 ui.notification_show(
                     "No diagram code available to generate links.",
                     type="warning",
                     duration=3
                 )
                 return
-                
-            code = last_code()
-            diagram_type = last_diagram_type()
-            
+
             try:
-                # Generate simple external links content
-                if diagram_type == "mermaid":
-                    # Create Mermaid Ink link
-                    mermaid_ink_encoded = base64_to_base64url(
-                        base64.b64encode(code.encode('utf-8')).decode('utf-8')
-                    )
-                    mermaid_ink_url = f"https://mermaid.ink/img/{mermaid_ink_encoded}"
-                    
-                    # Create Mermaid Live Editor link
-                    mermaid_json = json.dumps({
-                        "code": code,
-                        "mermaid": {"theme": "default"}
-                    })
-                    mermaid_live_encoded = base64_to_base64url(
-                        base64.b64encode(mermaid_json.encode('utf-8')).decode('utf-8')
-                    )
-                    mermaid_live_url = f"https://mermaid.live/edit#base64:{mermaid_live_encoded}"
-                    
-                    links_html = f"""
-                    <div class="mb-3">
-                        <h6>🖼️ Mermaid Ink (Image)</h6>
-                        <p class="small text-muted">Direct link to PNG image</p>
-                        <div class="input-group mb-2">
-                            <input type="text" class="form-control" value="{mermaid_ink_url}" readonly onclick="this.select()">
-                            <button class="btn btn-outline-secondary" onclick="window.open('{mermaid_ink_url}', '_blank')">Open</button>
-                        </div>
-                    </div>
-                    <div class="mb-3">
-                        <h6>✏️ Mermaid Live Editor</h6>
-                        <p class="small text-muted">Interactive editor</p>
-                        <div class="input-group mb-2">
-                            <input type="text" class="form-control" value="{mermaid_live_url}" readonly onclick="this.select()">
-                            <button class="btn btn-outline-secondary" onclick="window.open('{mermaid_live_url}', '_blank')">Open</button>
-                        </div>
-                    </div>
-                    """
-                    
-                elif diagram_type == "graphviz":
-                    # Create Kroki links
-                    encoded_code = create_kroki_encoding(code)
-                    kroki_svg_url = f"https://kroki.io/graphviz/svg/{encoded_code}"
-                    kroki_png_url = f"https://kroki.io/graphviz/png/{encoded_code}"
-                    
-                    links_html = f"""
-                    <div class="mb-3">
-                        <h6>📊 Kroki (SVG)</h6>
-                        <p class="small text-muted">Scalable vector graphics</p>
-                        <div class="input-group mb-2">
-                            <input type="text" class="form-control" value="{kroki_svg_url}" readonly onclick="this.select()">
-                            <button class="btn btn-outline-secondary" onclick="window.open('{kroki_svg_url}', '_blank')">Open</button>
-                        </div>
-                    </div>
-                    <div class="mb-3">
-                        <h6>🖼️ Kroki (PNG)</h6>
-                        <p class="small text-muted">Portable network graphics</p>
-                        <div class="input-group mb-2">
-                            <input type="text" class="form-control" value="{kroki_png_url}" readonly onclick="this.select()">
-                            <button class="btn btn-outline-secondary" onclick="window.open('{kroki_png_url}', '_blank')">Open</button>
-                        </div>
-                    </div>
-                    """
-                else:
-                    links_html = "<p>No external links available for this diagram type.</p>"
-                
+                # Generate simple external links content (cached per diagram)
+                links_html = _links_html_for(current.code, current.diagram_type)
+
                 # Show modal with the links
                 ui.modal_show(
                     ui.modal(
@@ -386,34 +451,28 @@ def diagrambot_chat(
         # Outputs
         @render.ui
         def diagram_output():
-            if not last_code():
+            current = state()
+            if not current.code:
                 return ui.div()
-            
-            code = last_code()
-            diagram_type = last_diagram_type()
-            return render_diagram_output(code, diagram_type)
+
+            return _render_diagram_cached(current.code, current.diagram_type)
 
         @reactive.effect(priority=-10)
         async def _play_shutter():
-            if last_code():
+            if state().code:
                 await session.send_custom_message("play_audio", {"selector": "#shutter"})
 
         @render.code
         def code_text():
-            if last_code():
-                return last_code()
-            return ""
+            return state().code
 
         @render.text
         def session_cost_chat():
-            cost = session_cost()
-            return f"${cost:.4f}"
+            return f"${session_cost():.4f}"
 
         @render.text
         def session_tokens_chat():
-            tokens_data = session_tokens()
-            total_tokens = tokens_data.get("tokens", 0)
-            return f"{total_tokens}"
+            return f"{session_tokens()}"
 
     app = App(app_ui, server, debug=debug)
     
@@ -2,51 +2,52 @@
 Utility functions for diagrambot.
 """
 
+import functools
 import os
 from pathlib import Path
 
 
+# Set once ensure_openai_api_key has succeeded so later calls (one per app
+# construction) skip the environment and .env file probes.
+_KEY_CHECKED = False
+
+
 def ensure_openai_api_key():
     """
     Ensure OPENAI_API_KEY is available in the environment.
-    
+
     Checks for OPENAI_API_KEY environment variable and attempts to load it
-    from .env files if not found.
-    
+    from .env files if not found. The check only runs once per process;
+    subsequent calls return immediately.
+
     Returns:
         bool: True if API key is available
-        
+
     Raises:
         ValueError: If API key cannot be found
     """
+    global _KEY_CHECKED
+    if _KEY_CHECKED:
+        return True
+
     if os.getenv("OPENAI_API_KEY"):
+        _KEY_CHECKED = True
         return True
-    
-    # Try to load from .env file
-    env_file = Path(".env")
-    if env_file.exists():
-        try:
-            from dotenv import load_dotenv
-            load_dotenv(env_file)
-            if os.getenv("OPENAI_API_KEY"):
-                print("Loaded OPENAI_API_KEY from .env file")
-                return True
-        except ImportError:
-            pass
-    
-    # Check for .env in project root
-    project_root = Path(__file__).parent.parent
-    env_file = project_root / ".env"
-    if env_file.exists():
-        try:
-            from dotenv import load_dotenv
-            load_dotenv(env_file)
-            if os.getenv("OPENAI_API_KEY"):
-                print("Loaded OPENAI_API_KEY from project .env file")
-                return True
-        except ImportError:
-            pass
-    
+
+    # Try to load from a .env file in the working directory or project root
+    env_files = (Path(".env"), Path(__file__).parent.parent / ".env")
+    for env_file in env_files:
+        if env_file.exists():
+            try:
+                from dotenv import load_dotenv
+                load_dotenv(env_file)
+                if os.getenv("OPENAI_API_KEY"):
+                    print(f"Loaded OPENAI_API_KEY from {env_file}")
+                    _KEY_CHECKED = True
+                    return True
+            except ImportError:
+                pass
+
     raise ValueError(
         "OPENAI_API_KEY environment variable is not set. "
         "You can set it with os.environ['OPENAI_API_KEY'] = 'your_api_key' "
@@ -54,19 +55,30 @@ def ensure_openai_api_key():
     )
 
 
+_DEFAULT_PROMPT_FILE = Path(__file__).parent / "prompts" / "prompt.md"
+
+
+@functools.lru_cache(maxsize=8)
+def _read_prompt(prompt_file: str) -> str:
+    """Read a prompt file from disk, caching the result per path."""
+    return Path(prompt_file).read_text()
+
+
 def build_prompt(prompt_file: str = None) -> str:
     """
     Build prompt for the diagrambot.
-    
+
     Reads the base prompt from the package for diagram generation.
-    
+    The file contents are cached, so repeated calls (e.g. one per
+    Shiny session) skip the disk read entirely.
+
     Args:
         prompt_file: Path to prompt file (optional)
-        
+
     Returns:
         str: The complete prompt
     """
     if prompt_file is None:
-        prompt_file = Path(__file__).parent / "prompts" / "prompt.md"
-    
-    return Path(prompt_file).read_text()
+        prompt_file = _DEFAULT_PROMPT_FILE
+
+    return _read_prompt(str(prompt_file))
@@ -1,23 +1,55 @@
 """
 Voice-enabled diagrambot Shiny application.
+
+Performance notes
+-----------------
+The hot helpers in this module (create_kroki_encoding, the link
+builders, hidden_audio_el, diagram HTML rendering) are all linear passes
+over bytes: UTF-8 encode, DEFLATE, base64, escaping. At the byte level
+they are memory-bandwidth-bound; at the orchestration level they are
+Python-interpreter-bound. The optimizations that pay off here are
+therefore (a) collapsing multiple Python-level passes into single C
+calls (urlsafe_b64encode, str.translate, bytes concatenation) and
+(b) optional SIMD-accelerated C extensions: pybase64 and libdeflate via
+the ``deflate`` package, installable with ``pip install
+diagrambot[perf]``. Threading or asyncio offload does not help these
+paths — they are CPU-bound and sub-millisecond per call — so keep future
+tuning on the same two rungs.
 """
 
 import base64
+import functools
+import hashlib
+import html
 import json
+import operator
 import zlib
 from pathlib import Path
 from typing import Any, Dict
 
-import shinychat
-from dotenv import load_dotenv
-from faicons import icon_svg
 from shiny import App, Inputs, Outputs, Session, reactive, render, req, ui
-from shinyrealtime import realtime_server, realtime_ui
 import urllib.parse
 
 from .utils import ensure_openai_api_key, build_prompt
 
-load_dotenv()
+try:
+    # pybase64 uses SIMD (SSSE3/AVX2/AVX-512) encode loops; it is an
+    # optional fast path and the stdlib module is a drop-in fallback
+    import pybase64 as _base64
+except ImportError:
+    _base64 = base64
+
+try:
+    # libdeflate (via the `deflate` package) compresses faster than zlib
+    # and usually a bit smaller at its top level, which directly shortens
+    # Kroki URLs; zlib level 9 is the stdlib fallback
+    import deflate as _libdeflate
+
+    def _zlib_compress(data: bytes) -> bytes:
+        return _libdeflate.zlib_compress(data, 12)
+except ImportError:
+    def _zlib_compress(data: bytes) -> bytes:
+        return zlib.compress(data, 9)
 
 pricing_gpt4_realtime = {
     "input_text": 4 / 1e6,
@@ -30,6 +62,11 @@ pricing_gpt4_realtime = {
     "output_audio": 64 / 1e6,
 }
 
+# Fixed price vector for the cost accumulation: _track_session_cost builds
+# its token counts in this same order, so the cost is a plain dot product
+# with no dict lookups per response.
+_PRICE_VEC = tuple(pricing_gpt4_realtime.values())
+
 pricing_gpt_4o_mini = {
     "input_text": 0.6 / 1e6,
     "input_audio": 10 / 1e6,
@@ -40,8 +77,14 @@ pricing_gpt_4o_mini = {
 }
 
 
+@functools.lru_cache(maxsize=None)
 def hidden_audio_el(id: str, file_path: str, media_type: str = "audio/mp3"):
-    """Create a hidden HTML audio element with embedded audio data."""
+    """Create a hidden HTML audio element with embedded audio data.
+
+    The element is cached per (id, file_path, media_type): the asset is
+    static, so the file read and base64 encode happen once per process
+    rather than on every app construction.
+    """
     file_path = Path(file_path)
     if not file_path.exists():
         return ui.HTML("")
@@ -49,11 +92,13 @@ def hidden_audio_el(id: str, file_path: str, media_type: str = "audio/mp3"):
     # Read binary data from file
     raw_data = file_path.read_bytes()
 
-    # Encode to base64
-    base64_data = base64.b64encode(raw_data).decode("utf-8")
-
-    # Create data URI
-    data_uri = f"data:{media_type};base64,{base64_data}"
+    # Build the data URI at the bytes level and decode once at the end:
+    # this skips the intermediate str of the (large) base64 payload, and
+    # the final ASCII decode takes CPython's fast path
+    data_uri = (
+        b"data:" + media_type.encode("ascii") + b";base64,"
+        + _base64.b64encode(raw_data)
+    ).decode("ascii")
 
     # Return HTML audio element
     return ui.HTML(
@@ -61,198 +106,190 @@ def hidden_audio_el(id: str, file_path: str, media_type: str = "audio/mp3"):
     )
 
 
+def _b64url(data: bytes) -> str:
+    """URL-safe base64 of ``data`` without padding, decoded to str."""
+    return _base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
 def base64_to_base64url(base64_str: str) -> str:
     """Convert base64 to base64url encoding."""
     return base64_str.replace("+", "-").replace("/", "_").rstrip("=")
 
 
+@functools.lru_cache(maxsize=128)
 def create_kroki_encoding(code: str) -> str:
-    """Create URL-safe encoding for Kroki (deflate + base64url)."""
-    # Compress using zlib (equivalent to Python's gzip)
-    compressed = zlib.compress(code.encode('utf-8'))
-    base64_encoded = base64.b64encode(compressed).decode('utf-8')
-    return base64_to_base64url(base64_encoded)
+    """Create URL-safe encoding for Kroki (deflate + base64url).
+
+    Results are memoized so repeat requests for the same diagram skip the
+    DEFLATE pass entirely.
+    """
+    # Compress at maximum level: DEFLATE dominates the cost here and a
+    # smaller payload also means a shorter Kroki URL.
+    #
+    # A preset zlib dictionary of common Mermaid/Graphviz keywords would
+    # shrink small payloads further, but inflate then requires the same
+    # dictionary on the decoding side and kroki.io only accepts plain
+    # zlib streams, so the resulting URLs would 400. Stick to standard
+    # DEFLATE for interoperability.
+    compressed = _zlib_compress(code.encode('utf-8'))
+    return _b64url(compressed)
+
+
+# Copy/open row shared by every external-link card; built once, with only
+# the URL substituted per call. {url_attr} is the HTML-escaped URL for
+# attribute values; {url_js} is a JS string literal (json.dumps output,
+# then HTML-escaped) so quotes in a URL can't break out of the handlers.
+_LINK_ROW_TEMPLATE = '''
+    <div class="input-group mb-2">
+        <input type="text" class="form-control font-monospace small"
+               value="{url_attr}" readonly onclick="this.select()">
+        <button class="btn btn-outline-secondary" type="button"
+                onclick="navigator.clipboard.writeText({url_js})">
+            <i class="fas fa-copy"></i> Copy
+        </button>
+        <button class="btn btn-primary" type="button"
+                onclick="window.open({url_js}, '_blank')">
+            <i class="fas fa-external-link"></i> Open
+        </button>
+    </div>
+'''
+
+
+def _link_section(title: str, description: str, url: str):
+    """Build one external-link card: heading, blurb, and copy/open row."""
+    row = _LINK_ROW_TEMPLATE.format_map({
+        "url_attr": html.escape(url, quote=True),
+        "url_js": html.escape(json.dumps(url), quote=True),
+    })
+    return ui.div(
+        {"class": "mb-3"},
+        ui.h6(title),
+        ui.p({"class": "small text-muted"}, description),
+        ui.HTML(row),
+    )
+
+
+def _build_mermaid_links(code: str) -> ui.TagList:
+    """Build the Mermaid Ink and Live Editor link sections."""
+    # Create Mermaid Ink link using base64url encoding
+    mermaid_ink_encoded = _b64url(code.encode('utf-8'))
+    mermaid_ink_url = f"https://mermaid.ink/img/{mermaid_ink_encoded}"
+
+    # Create Mermaid Live Editor link using JSON format. Only the code
+    # varies, so escape it with json.dumps and splice it into the fixed
+    # wrapper instead of building and walking a dict per call.
+    mermaid_json = (
+        '{"code":' + json.dumps(code) + ',"mermaid":{"theme":"default"}}'
+    )
+    mermaid_live_encoded = _b64url(mermaid_json.encode('utf-8'))
+    mermaid_live_url = f"https://mermaid.live/edit#base64:{mermaid_live_encoded}"
+
+    return ui.TagList(
+        _link_section(
+            "🖼️ Mermaid Ink (Image)",
+            "Direct link to PNG image - great for embedding in documents",
+            mermaid_ink_url,
+        ),
+        _link_section(
+            "✏️ Mermaid Live Editor",
+            "Interactive editor for viewing and editing your diagram",
+            mermaid_live_url,
+        ),
+    )
+
+
+def _build_graphviz_links(code: str) -> ui.TagList:
+    """Build the Graphviz Online and Kroki link sections."""
+    # Create Kroki links using deflate+base64url encoding
+    encoded_code = create_kroki_encoding(code)
+    kroki_svg_url = f"https://kroki.io/graphviz/svg/{encoded_code}"
+    kroki_png_url = f"https://kroki.io/graphviz/png/{encoded_code}"
+
+    # Create Graphviz Online link using URL encoding
+    graphviz_online_encoded = urllib.parse.quote(code)
+    graphviz_online_url = f"https://dreampuf.github.io/GraphvizOnline/#{graphviz_online_encoded}"
+
+    return ui.TagList(
+        _link_section(
+            "✏️ Graphviz Online",
+            "Interactive editor for viewing and editing your diagram",
+            graphviz_online_url,
+        ),
+        _link_section(
+            "📊 Kroki (SVG)",
+            "Scalable vector graphics - perfect for high-quality displays",
+            kroki_svg_url,
+        ),
+        _link_section(
+            "🖼️ Kroki (PNG)",
+            "Portable network graphics - ideal for embedding in documents",
+            kroki_png_url,
+        ),
+    )
+
+
+# Dispatch table for link builders; adding a diagram type is one entry.
+_LINK_BUILDERS = {
+    "mermaid": _build_mermaid_links,
+    "graphviz": _build_graphviz_links,
+}
 
 
 def generate_external_links_content(code: str, diagram_type: str) -> ui.TagList:
     """Generate external links for diagrams."""
-    if diagram_type == "mermaid":
-        # Create Mermaid Ink link using base64url encoding
-        mermaid_ink_encoded = base64_to_base64url(
-            base64.b64encode(code.encode('utf-8')).decode('utf-8')
-        )
-        mermaid_ink_url = f"https://mermaid.ink/img/{mermaid_ink_encoded}"
-
-        # Create Mermaid Live Editor link using JSON format
-        mermaid_json = json.dumps({
-            "code": code,
-            "mermaid": {"theme": "default"}
-        })
-        mermaid_live_encoded = base64_to_base64url(
-            base64.b64encode(mermaid_json.encode('utf-8')).decode('utf-8')
-        )
-        mermaid_live_url = f"https://mermaid.live/edit#base64:{mermaid_live_encoded}"
-
-        return ui.TagList(
-            ui.div(
-                {"class": "mb-3"},
-                ui.h6("🖼️ Mermaid Ink (Image)"),
-                ui.p(
-                    {"class": "small text-muted"},
-                    "Direct link to PNG image - great for embedding in documents"
-                ),
-                ui.HTML(f'''
-                    <div class="input-group mb-2">
-                        <input type="text" class="form-control font-monospace small" 
-                               value="{mermaid_ink_url}" readonly onclick="this.select()">
-                        <button class="btn btn-outline-secondary" type="button"
-                                onclick="navigator.clipboard.writeText('{mermaid_ink_url}')">
-                            <i class="fas fa-copy"></i> Copy
-                        </button>
-                        <button class="btn btn-primary" type="button"
-                                onclick="window.open('{mermaid_ink_url}', '_blank')">
-                            <i class="fas fa-external-link"></i> Open
-                        </button>
-                    </div>
-                ''')
-            ),
-            ui.div(
-                {"class": "mb-3"},
-                ui.h6("✏️ Mermaid Live Editor"),
-                ui.p(
-                    {"class": "small text-muted"},
-                    "Interactive editor for viewing and editing your diagram"
-                ),
-                ui.HTML(f'''
-                    <div class="input-group mb-2">
-                        <input type="text" class="form-control font-monospace small" 
-                               value="{mermaid_live_url}" readonly onclick="this.select()">
-                        <button class="btn btn-outline-secondary" type="button"
-                                onclick="navigator.clipboard.writeText('{mermaid_live_url}')">
-                            <i class="fas fa-copy"></i> Copy
-                        </button>
-                        <button class="btn btn-primary" type="button"
-                                onclick="window.open('{mermaid_live_url}', '_blank')">
-                            <i class="fas fa-external-link"></i> Open
-                        </button>
-                    </div>
-                ''')
-            )
-        )
-    elif diagram_type == "graphviz":
-        # Create Kroki links using deflate+base64url encoding
-        encoded_code = create_kroki_encoding(code)
-        kroki_svg_url = f"https://kroki.io/graphviz/svg/{encoded_code}"
-        kroki_png_url = f"https://kroki.io/graphviz/png/{encoded_code}"
-        
-        # Create Graphviz Online link using URL encoding
-        graphviz_online_encoded = urllib.parse.quote(code)
-        graphviz_online_url = f"https://dreampuf.github.io/GraphvizOnline/#{graphviz_online_encoded}"
-
-        return ui.TagList(
-            ui.div(
-                {"class": "mb-3"},
-                ui.h6("✏️ Graphviz Online"),
-                ui.p(
-                    {"class": "small text-muted"},
-                    "Interactive editor for viewing and editing your diagram"
-                ),
-                ui.HTML(f'''
-                    <div class="input-group mb-2">
-                        <input type="text" class="form-control font-monospace small" 
-                               value="{graphviz_online_url}" readonly onclick="this.select()">
-                        <button class="btn btn-outline-secondary" type="button"
-                                onclick="navigator.clipboard.writeText('{graphviz_online_url}')">
-                            <i class="fas fa-copy"></i> Copy
-                        </button>
-                        <button class="btn btn-primary" type="button"
-                                onclick="window.open('{graphviz_online_url}', '_blank')">
-                            <i class="fas fa-external-link"></i> Open
-                        </button>
-                    </div>
-                ''')
-            ),
-            ui.div(
-                {"class": "mb-3"},
-                ui.h6("📊 Kroki (SVG)"),
-                ui.p(
-                    {"class": "small text-muted"},
-                    "Scalable vector graphics - perfect for high-quality displays"
-                ),
-                ui.HTML(f'''
-                    <div class="input-group mb-2">
-                        <input type="text" class="form-control font-monospace small" 
-                               value="{kroki_svg_url}" readonly onclick="this.select()">
-                        <button class="btn btn-outline-secondary" type="button"
-                                onclick="navigator.clipboard.writeText('{kroki_svg_url}')">
-                            <i class="fas fa-copy"></i> Copy
-                        </button>
-                        <button class="btn btn-primary" type="button"
-                                onclick="window.open('{kroki_svg_url}', '_blank')">
-                            <i class="fas fa-external-link"></i> Open
-                        </button>
-                    </div>
-                ''')
-            ),
-            ui.div(
-                {"class": "mb-3"},
-                ui.h6("🖼️ Kroki (PNG)"),
-                ui.p(
-                    {"class": "small text-muted"},
-                    "Portable network graphics - ideal for embedding in documents"
-                ),
-                ui.HTML(f'''
-                    <div class="input-group mb-2">
-                        <input type="text" class="form-control font-monospace small" 
-                               value="{kroki_png_url}" readonly onclick="this.select()">
-                        <button class="btn btn-outline-secondary" type="button"
-                                onclick="navigator.clipboard.writeText('{kroki_png_url}')">
-                            <i class="fas fa-copy"></i> Copy
-                        </button>
-                        <button class="btn btn-primary" type="button"
-                                onclick="window.open('{kroki_png_url}', '_blank')">
-                            <i class="fas fa-external-link"></i> Open
-                        </button>
-                    </div>
-                ''')
-            )
-        )
-    else:
+    builder = _LINK_BUILDERS.get(diagram_type)
+    if builder is None:
         return ui.div(
             {"class": "alert alert-info"},
             ui.HTML('<i class="fas fa-info-circle me-2"></i>'),
             "No external links available for this diagram type"
         )
+    return builder(code)
+
+
+# Escapes for embedding diagram source in a JS template literal. One
+# translate pass replaces the old chained str.replace calls, whose
+# ordering re-escaped the backslashes it had just inserted; $ is escaped
+# too so ${...} in diagram text can't be interpolated.
+_JS_TEMPLATE_ESCAPE = str.maketrans({"\\": "\\\\", "`": "\\`", "$": "\\$"})
+
+# Client-side renderer function per diagram type (see diagram-renderers.js).
+_RENDERER_JS_FUNCS = {
+    "mermaid": "renderMermaidDiagram",
+    "graphviz": "renderGraphvizDiagram",
+}
+
+
+@functools.lru_cache(maxsize=32)
+def _render_diagram_html(code: str, diagram_type: str) -> str:
+    """Build the diagram container HTML, cached per (code, diagram_type).
+
+    The element ID is derived from a short digest of the code rather than
+    a random value so the output is deterministic and cacheable: repeat
+    renders of the same source skip the escaping and HTML assembly.
+    """
+    renderer = _RENDERER_JS_FUNCS.get(diagram_type)
+    if renderer is None:  # unknown types fall back to mermaid, as before
+        diagram_type = "mermaid"
+        renderer = _RENDERER_JS_FUNCS["mermaid"]
+
+    digest = hashlib.blake2b(code.encode('utf-8'), digest_size=4).hexdigest()
+    diagram_id = f"{diagram_type}-{digest}"
+    escaped_code = code.translate(_JS_TEMPLATE_ESCAPE)
+    return f'''
+        <div id="{diagram_id}" style="width: 100%; height: 100%; min-height: 400px;">
+            <script>
+                setTimeout(function() {{
+                    {renderer}('{diagram_id}', `{escaped_code}`);
+                }}, 500);
+            </script>
+        </div>
+    '''
 
 
 def render_diagram_output(code: str, diagram_type: str) -> ui.HTML:
     """Render diagram output with error handling."""
-    import random
-    
-    if diagram_type == "graphviz":
-        diagram_id = f"graphviz-{random.randint(10000, 99999)}"
-        escaped_code = code.replace("`", "\\`").replace("\\", "\\\\")
-        return ui.HTML(f'''
-            <div id="{diagram_id}" style="width: 100%; height: 100%; min-height: 400px;">
-                <script>
-                    setTimeout(function() {{ 
-                        renderGraphvizDiagram('{diagram_id}', `{escaped_code}`); 
-                    }}, 500);
-                </script>
-            </div>
-        ''')
-    else:  # mermaid
-        diagram_id = f"mermaid-{random.randint(10000, 99999)}"
-        escaped_code = code.replace("`", "\\`").replace("\\", "\\\\")
-        return ui.HTML(f'''
-            <div id="{diagram_id}" style="width: 100%; height: 100%; min-height: 400px;">
-                <script>
-                    setTimeout(function() {{ 
-                        renderMermaidDiagram('{diagram_id}', `{escaped_code}`); 
-                    }}, 500);
-                </script>
-            </div>
-        ''')
+    return ui.HTML(_render_diagram_html(code, diagram_type))
 
 
 def create_diagram_tool(last_code, last_diagram_type, debug=False):
@@ -271,37 +308,23 @@ def create_diagram_tool(last_code, last_diagram_type, debug=False):
     return generate_diagram
 
 
-def diagrambot_voice(
-    prompt_file: str = None,
-    voice: str = "cedar",
-    speed: float = 1.1,
-    debug: bool = False,
-    launch_browser: bool = True,
-    port: int = 0
-) -> App:
-    """
-    Create a voice-enabled diagrambot Shiny application.
-    
-    Args:
-        prompt_file: Path to the prompt file (defaults to bundled prompt)
-        voice: Voice to use for audio responses
-        speed: Speech speed
-        debug: Enable debug mode
-        launch_browser: Launch browser automatically
-        port: Port to run on (0 for auto)
-        
-    Returns:
-        Shiny App instance
+@functools.lru_cache(maxsize=1)
+def _build_app_ui():
+    """Build the page UI, shared across diagrambot_voice invocations.
+
+    The page is entirely static — voice, speed and prompt only affect the
+    realtime server, not the markup — so one tag tree can serve every app
+    construction. lru_cache keeps the first build and skips the (large)
+    page assembly on repeat calls.
     """
-    
-    # Ensure OpenAI API key is available
-    ensure_openai_api_key()
-    
-    # Load prompt
-    prompt = build_prompt(prompt_file)
-    
-    # UI
-    app_ui = ui.page_sidebar(
+    # Imported here rather than at module level: these pull in the full
+    # chat/realtime UI machinery, which callers that only import this
+    # module (e.g. for the encoding helpers) never need.
+    import shinychat
+    from faicons import icon_svg
+    from shinyrealtime import realtime_ui
+
+    return ui.page_sidebar(
         ui.sidebar(
             ui.help_text("Session cost:", ui.output_text("session_cost", inline=True)),
             shinychat.output_markdown_stream("response_text"),
@@ -364,40 +387,49 @@ def diagrambot_voice(
         ui.tags.head(
             ui.include_js(Path(__file__).parent / "assets" / "www" / "diagram-renderers.js"),
             ui.include_js(Path(__file__).parent / "assets" / "www" / "personal-instructions.js"),
-            ui.tags.script(
-                """
-                Shiny.addCustomMessageHandler("copy_to_clipboard", function(msg) {
-                    console.log('Copy to clipboard handler called with:', msg);
-                    const text = msg.text;
-                    navigator.clipboard.writeText(text).then(function() {
-                        console.log("Copied successfully:", text.substring(0, 50) + "...");
-                    }).catch(function(err) {
-                        console.warn("Copy failed:", err);
-                        // Fallback method
-                        try {
-                            const textArea = document.createElement('textarea');
-                            textArea.value = text;
-                            textArea.style.position = 'fixed';
-                            textArea.style.left = '-999999px';
-                            textArea.style.top = '-999999px';
-                            document.body.appendChild(textArea);
-                            textArea.focus();
-                            textArea.select();
-                            document.execCommand('copy');
-                            document.body.removeChild(textArea);
-                            console.log("Copied using fallback method");
-                        } catch (fallbackErr) {
-                            console.error("Fallback copy also failed:", fallbackErr);
-                        }
-                    });
-                });
-                """
-            )
+            ui.include_js(Path(__file__).parent / "assets" / "www" / "copy-handler.js"),
         ),
         title="diagrambot",
         fillable=True,
         style="--bslib-spacer: 1rem; padding-bottom: 0;",
     )
+
+
+def diagrambot_voice(
+    prompt_file: str = None,
+    voice: str = "cedar",
+    speed: float = 1.1,
+    debug: bool = False,
+    launch_browser: bool = True,
+    port: int = 0
+) -> App:
+    """
+    Create a voice-enabled diagrambot Shiny application.
+    
+    Args:
+        prompt_file: Path to the prompt file (defaults to bundled prompt)
+        voice: Voice to use for audio responses
+        speed: Speech speed
+        debug: Enable debug mode
+        launch_browser: Launch browser automatically
+        port: Port to run on (0 for auto)
+        
+    Returns:
+        Shiny App instance
+    """
+    # Lazy for the same reason as in _build_app_ui
+    import shinychat
+    from shinyrealtime import realtime_server
+
+    # Ensure OpenAI API key is available
+    ensure_openai_api_key()
+
+    # Load prompt (build_prompt caches file reads, so repeat app
+    # constructions skip the disk I/O)
+    prompt = build_prompt(prompt_file)
+
+    # UI (static, cached across invocations)
+    app_ui = _build_app_ui()
     
     # Server
     def server(input: Inputs, output: Outputs, session: Session):
@@ -406,18 +438,6 @@ def diagrambot_voice(
         running_cost = reactive.value(0)
         user_instructions = reactive.value("")
 
-        # Pricing for GPT-4 Realtime API
-        pricing_gpt4_realtime = {
-            "input_text": 4 / 1e6,
-            "input_audio": 32 / 1e6,
-            "input_image": 5 / 1e6,
-            "input_text_cached": 0.4 / 1e6,
-            "input_audio_cached": 0.4 / 1e6,
-            "input_image_cached": 0.5 / 1e6,
-            "output_text": 16 / 1e6,
-            "output_audio": 64 / 1e6,
-        }
-
         # Handle instructions from localStorage
         instructions_ready = reactive.value(False)
         realtime_server_created = reactive.value(False)
@@ -427,7 +447,11 @@ def diagrambot_voice(
         def _handle_stored_instructions():
             """Load instructions from localStorage when available."""
             try:
-                stored_value = input.user_instructions_from_storage()
+                # Single isolated read: the effect is already triggered by
+                # reactive.event, so no extra dependency should be
+                # registered on the input
+                with reactive.isolate():
+                    stored_value = input.user_instructions_from_storage()
                 # Set the value even if it's empty
                 user_instructions.set(stored_value if stored_value else "")
                 if debug:
@@ -541,22 +565,21 @@ def diagrambot_voice(
                 output_token_details = usage.get("output_token_details", {})
                 cached_tokens_details = input_token_details.get("cached_tokens_details", {})
 
-                current_response = {
-                    "input_text": input_token_details.get("text_tokens", 0),
-                    "input_audio": input_token_details.get("audio_tokens", 0),
-                    "input_image": input_token_details.get("image_tokens", 0),
-                    "input_text_cached": cached_tokens_details.get("text_tokens", 0),
-                    "input_audio_cached": cached_tokens_details.get("audio_tokens", 0),
-                    "input_image_cached": cached_tokens_details.get("image_tokens", 0),
-                    "output_text": output_token_details.get("text_tokens", 0),
-                    "output_audio": output_token_details.get("audio_tokens", 0),
-                }
+                # Token counts in pricing_gpt4_realtime key order, so the
+                # cost is a dot product against _PRICE_VEC
+                token_counts = (
+                    input_token_details.get("text_tokens", 0),
+                    input_token_details.get("audio_tokens", 0),
+                    input_token_details.get("image_tokens", 0),
+                    cached_tokens_details.get("text_tokens", 0),
+                    cached_tokens_details.get("audio_tokens", 0),
+                    cached_tokens_details.get("image_tokens", 0),
+                    output_token_details.get("text_tokens", 0),
+                    output_token_details.get("audio_tokens", 0),
+                )
 
                 # Calculate cost
-                cost = 0
-                for k, v in current_response.items():
-                    if k in pricing_gpt4_realtime:
-                        cost += v * pricing_gpt4_realtime[k]
+                cost = sum(map(operator.mul, token_counts, _PRICE_VEC))
 
                 with reactive.isolate():
                     running_cost.set(running_cost() + cost)
@@ -633,17 +656,18 @@ def diagrambot_voice(
         @reactive.effect
         @reactive.event(input.external_links)
         def _show_external_links():
-            if not last_code():
+            # Read each reactive value once; the guard reuses the local
+            code = last_code()
+            if not code:
                 ui.notification_show(
                     "No diagram code available to generate links.",
                     type="warning",
                     duration=3
                 )
                 return
-                
-            code = last_code()
+
             diagram_type = last_diagram_type()
-            
+
             try:
                 # Generate the external links content
                 links_content = generate_external_links_content(code, diagram_type)
@@ -676,11 +700,10 @@ def diagrambot_voice(
         @reactive.Effect
         @reactive.event(input.copy_code)
         async def _copy_code():
-            if not last_code():
-                return
-                
             code_to_copy = last_code()
-            
+            if not code_to_copy:
+                return
+
             # Send the code to the browser for copying
             await session.send_custom_message(
                 "copy_to_clipboard",
@@ -697,12 +720,11 @@ def diagrambot_voice(
         # Outputs
         @render.ui
         def diagram_output():
-            if not last_code():
-                return ui.div()
-            
             code = last_code()
-            diagram_type = last_diagram_type()
-            return render_diagram_output(code, diagram_type)
+            if not code:
+                return ui.div()
+
+            return render_diagram_output(code, last_diagram_type())
 
         @reactive.effect(priority=-10)
         async def _play_shutter():
@@ -711,9 +733,7 @@ def diagrambot_voice(
 
         @render.code
         def code_text():
-            if last_code():
-                return last_code()
-            return ""
+            return last_code() or ""
 
         @render.text
         def session_cost():